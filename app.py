@@ -1,12 +1,21 @@
+import io
+import json
+import math
 import os
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, send_file, render_template
 from flask_cors import CORS
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from psycopg2 import errors as pg_errors
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import RealDictCursor, execute_values
+from datetime import datetime, timezone
 import mercadopago
-from fpdf import FPDF
-from thefuzz import process
+import redis
+from fpdf import FPDF, XPos, YPos
 
 app = Flask(__name__)
 CORS(app)
@@ -15,16 +24,151 @@ CORS(app)
 # No Render, a variável DATABASE_URL conecta automaticamente ao Supabase
 DATABASE_URL = os.getenv("DATABASE_URL")
 MP_ACCESS_TOKEN = os.getenv("MP_ACCESS_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL")
 
 # Inicializa SDK apenas se tiver token
 sdk = mercadopago.SDK(MP_ACCESS_TOKEN) if MP_ACCESS_TOKEN else None
 
-def get_db_connection():
-    if not DATABASE_URL:
-        raise Exception("A variável de ambiente DATABASE_URL não foi definida.")
-    # sslmode='require' é obrigatório para conexão com Supabase
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-    return conn
+# Semelhança mínima (pg_trgm) para vincular um PIX a um membro
+MATCH_SIMILARITY = 0.55
+
+# --- CACHE DO DASHBOARD ---
+# O resumo do mês só muda com entradas confirmadas ou despesas, então é guardado
+# por alguns segundos e invalidado pelas rotas que alteram esses dados.
+# Com REDIS_URL o cache fica no Redis (compartilhado entre os workers do gunicorn);
+# sem ele, fica na memória do processo.
+# Nos dois casos há uma geração incrementada a cada alteração: um cálculo que
+# começou antes da alteração não sobrescreve o cache com o valor antigo.
+_DASH_TTL = 30
+dash_redis = redis.Redis.from_url(REDIS_URL, socket_timeout=1) if REDIS_URL else None
+_dash_cache = {"gen": 0, "t": 0, "month": None, "v": None}
+_dash_lock = threading.Lock()
+
+def invalidate_dashboard_cache():
+    if not dash_redis:
+        with _dash_lock:
+            _dash_cache["gen"] += 1
+            _dash_cache["v"] = None
+        return
+    try:
+        dash_redis.incr("dash:gen")
+    except redis.RedisError as e:
+        print(f"Erro ao invalidar cache do dashboard: {e}")
+
+def current_month():
+    # Mesmo relógio do CURRENT_DATE do banco (Supabase roda em UTC)
+    return datetime.now(timezone.utc).strftime('%Y-%m')
+
+# --- POOL DE CONEXÕES ---
+# Reaproveita as conexões entre requisições, evitando o handshake TLS + autenticação
+# no Supabase a cada chamada. sslmode='require' é obrigatório para conexão com Supabase
+STATEMENT_TIMEOUT_MS = int(os.getenv("STATEMENT_TIMEOUT_MS", "15000"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_WAIT = 30
+
+# O ThreadedConnectionPool lança PoolError quando esgota; o semáforo faz a
+# requisição esperar uma conexão livre (com gevent, a espera cede para outras greenlets)
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+class PooledConnection(PgConnection):
+    # Marca se os prepared statements já foram criados nesta sessão
+    prepared = False
+    # Vira False se a conexão passa por um pooler em modo transação (ex.: Supabase
+    # na porta 6543), onde a sessão do servidor muda entre transações
+    prepare_supported = True
+
+# Criado só no primeiro uso: se o banco estiver fora do ar na inicialização, o app
+# sobe mesmo assim (a rota '/' continua funcionando) e a conexão é tentada de novo
+# na próxima requisição
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        if not DATABASE_URL:
+            raise Exception("A variável de ambiente DATABASE_URL não foi definida.")
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    minconn=1, maxconn=DB_POOL_MAX, dsn=DATABASE_URL, sslmode='require',
+                    application_name='sistemaibiphb',
+                    options=f'-c statement_timeout={STATEMENT_TIMEOUT_MS}',
+                    connection_factory=PooledConnection,
+                )
+    return _pool
+
+# Consultas quentes preparadas uma vez por conexão: o servidor guarda o plano e
+# cada requisição só faz EXECUTE. Prepared statements vivem na sessão, então em
+# um pooler em modo transação a consulta cai para o SQL normal (ver execute_prepared).
+PREPARED_STATEMENTS = {
+    "dashboard_totals": """
+        WITH i AS (
+            SELECT COALESCE(SUM(amount), 0) AS v FROM transactions
+            WHERE status = 'confirmado'
+            AND transaction_date >= date_trunc('month', CURRENT_DATE)
+            AND transaction_date < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
+        ),
+        o AS (
+            SELECT COALESCE(SUM(amount), 0) AS v FROM expenses
+            WHERE expense_date >= date_trunc('month', CURRENT_DATE)
+            AND expense_date < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
+        )
+        SELECT i.v AS inflow, o.v AS outflow FROM i, o
+    """,
+}
+
+def prepare_statements(conn):
+    try:
+        with conn.cursor() as cur:
+            for name, sql in PREPARED_STATEMENTS.items():
+                cur.execute(f"PREPARE {name} AS {sql}")
+        conn.commit()
+        conn.prepared = True
+    except pg_errors.DuplicatePreparedStatement:
+        # Outra conexão do pooler já preparou nesta sessão do servidor
+        conn.rollback()
+        conn.prepare_supported = False
+
+def execute_prepared(conn, cur, name):
+    if conn.prepare_supported:
+        if not conn.prepared:
+            prepare_statements(conn)
+        if conn.prepare_supported:
+            try:
+                cur.execute(f"EXECUTE {name}")
+                return
+            except pg_errors.InvalidSqlStatementName:
+                conn.rollback()
+                conn.prepare_supported = False
+    cur.execute(PREPARED_STATEMENTS[name])
+
+@contextmanager
+def db_cursor(dict_cursor=False):
+    pool = get_pool()
+    if not _pool_slots.acquire(timeout=DB_POOL_WAIT):
+        raise Exception("Tempo esgotado esperando uma conexão livre com o banco.")
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor if dict_cursor else None)
+        try:
+            yield conn, cur
+            conn.commit()
+        finally:
+            cur.close()
+    except Exception:
+        # Se o servidor já derrubou a conexão, o rollback falharia e esconderia o erro original
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Conexões quebradas são descartadas em vez de voltar para o pool
+        pool.putconn(conn, close=bool(conn.closed))
+        _pool_slots.release()
 
 # --- ROTA PARA O FRONTEND (ESSENCIAL PARA FULLSTACK) ---
 @app.route('/')
@@ -35,48 +179,63 @@ def index():
 # --- CRIAÇÃO AUTOMÁTICA DAS TABELAS ---
 def create_tables():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Tabela Membros
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS members (
-                id SERIAL PRIMARY KEY,
-                code VARCHAR(10) UNIQUE NOT NULL,
-                full_name VARCHAR(255) NOT NULL,
-                birth_date DATE
-            );
-        """)
+        with db_cursor() as (conn, cur):
+            # DDL de inicialização não segue o statement_timeout das requisições
+            # (CREATE INDEX em tabela grande pode demorar); SET LOCAL vale só aqui
+            cur.execute("SET LOCAL statement_timeout = 0")
+
+            # Tabela Membros
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS members (
+                    id SERIAL PRIMARY KEY,
+                    code VARCHAR(10) UNIQUE NOT NULL,
+                    full_name VARCHAR(255) NOT NULL,
+                    birth_date DATE
+                );
+            """)
         
-        # Tabela Transações (Entradas/PIX)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id SERIAL PRIMARY KEY,
-                mp_id VARCHAR(50) UNIQUE,
-                payer_name VARCHAR(255),
-                member_id INTEGER REFERENCES members(id) ON DELETE SET NULL,
-                amount NUMERIC(10, 2),
-                transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status VARCHAR(20) DEFAULT 'pendente', -- pendente, confirmado
-                origin VARCHAR(20), -- pix, manual
-                type VARCHAR(20) -- dizimo, oferta
-            );
-        """)
+            # Tabela Transações (Entradas/PIX)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id SERIAL PRIMARY KEY,
+                    mp_id VARCHAR(50) UNIQUE,
+                    payer_name VARCHAR(255),
+                    member_id INTEGER REFERENCES members(id) ON DELETE SET NULL,
+                    amount NUMERIC(10, 2),
+                    transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status VARCHAR(20) DEFAULT 'pendente', -- pendente, confirmado
+                    origin VARCHAR(20), -- pix, manual
+                    type VARCHAR(20) -- dizimo, oferta
+                );
+            """)
         
-        # Tabela Despesas (Saídas)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id SERIAL PRIMARY KEY,
-                description VARCHAR(255) NOT NULL,
-                category VARCHAR(100),
-                amount NUMERIC(10, 2) NOT NULL,
-                expense_date DATE DEFAULT CURRENT_DATE
-            );
-        """)
+            # Tabela Despesas (Saídas)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS expenses (
+                    id SERIAL PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    category VARCHAR(100),
+                    amount NUMERIC(10, 2) NOT NULL,
+                    expense_date DATE DEFAULT CURRENT_DATE
+                );
+            """)
+
+            # Índices para os filtros por período (dashboard/relatório) e para o JOIN com membros
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_tx_date_status ON transactions (transaction_date) WHERE status = 'confirmado';
+                CREATE INDEX IF NOT EXISTS idx_exp_date ON expenses (expense_date);
+                CREATE INDEX IF NOT EXISTS idx_tx_member ON transactions (member_id);
+                CREATE INDEX IF NOT EXISTS idx_tx_status_date ON transactions (status, transaction_date DESC);
+            """)
+
+        # Busca por semelhança de nomes no próprio banco (vínculo automático do webhook)
+        with db_cursor() as (conn, cur):
+            cur.execute("SET LOCAL statement_timeout = 0")
+            cur.execute("""
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS idx_members_name_trgm ON members USING gin (full_name gin_trgm_ops);
+            """)
         
-        conn.commit()
-        cur.close()
-        conn.close()
         print("--- Banco de Dados Conectado e Tabelas Verificadas ---")
     except Exception as e:
         print(f"Erro ao criar tabelas: {e}")
@@ -86,6 +245,58 @@ if DATABASE_URL:
     create_tables()
 
 # --- WEBHOOK MERCADO PAGO ---
+# O processamento roda fora da requisição para responder ao Mercado Pago na hora
+# (ele reenvia a notificação se a resposta demorar)
+executor = ThreadPoolExecutor(max_workers=4)
+
+def _process_payment(payment_id):
+    try:
+        # Buscar detalhes do pagamento
+        payment_info = sdk.payment().get(payment_id)
+        payment = payment_info["response"]
+        
+        if payment["status"] == "approved":
+            payer = payment.get("payer", {})
+            # Monta nome completo
+            first = payer.get("first_name", "")
+            last = payer.get("last_name", "")
+            payer_name = f"{first} {last}".strip()
+            
+            amount = payment["transaction_amount"]
+            date_created = payment["date_created"] 
+
+            with db_cursor() as (conn, cur):
+                # --- Lógica de Fuzzy Match (Vínculo Automático) ---
+                # O pg_trgm (índice GIN em members.full_name) devolve o membro mais parecido,
+                # se tiver semelhança suficiente (MATCH_SIMILARITY).
+                # Roda num SAVEPOINT: se falhar (ex.: extensão pg_trgm ausente), a transação
+                # ainda é registrada, só que sem vínculo
+                best_match_id = None
+                cur.execute("SAVEPOINT member_match")
+                try:
+                    cur.execute("""
+                        SELECT id FROM members
+                        WHERE full_name %% %s AND similarity(full_name, %s) >= %s
+                        ORDER BY similarity(full_name, %s) DESC LIMIT 1
+                    """, (payer_name, payer_name, MATCH_SIMILARITY, payer_name))
+                    match = cur.fetchone()
+                    if match:
+                        best_match_id = match[0]
+                    cur.execute("RELEASE SAVEPOINT member_match")
+                except pg_errors.Error as e:
+                    print(f"Erro no vínculo automático do webhook: {e}")
+                    cur.execute("ROLLBACK TO SAVEPOINT member_match")
+
+                # Insere Transação
+                cur.execute("""
+                    INSERT INTO transactions (mp_id, payer_name, member_id, amount, transaction_date, status, origin)
+                    VALUES (%s, %s, %s, %s, %s, 'pendente', 'pix')
+                    ON CONFLICT (mp_id) DO NOTHING
+                """, (str(payment_id), payer_name, best_match_id, amount, date_created))
+                conn.commit()
+    except Exception as e:
+        print(f"Erro no webhook: {e}")
+
 @app.route('/webhook/mercadopago', methods=['POST'])
 def mp_webhook():
     if not sdk: return jsonify({"error": "SDK não configurado"}), 500
@@ -100,48 +311,8 @@ def mp_webhook():
         if not payment_id:
              return jsonify({"status": "ignored", "reason": "no id found"}), 200
 
-        try:
-            # Buscar detalhes do pagamento
-            payment_info = sdk.payment().get(payment_id)
-            payment = payment_info["response"]
-            
-            if payment["status"] == "approved":
-                payer = payment.get("payer", {})
-                # Monta nome completo
-                first = payer.get("first_name", "")
-                last = payer.get("last_name", "")
-                payer_name = f"{first} {last}".strip()
-                
-                amount = payment["transaction_amount"]
-                date_created = payment["date_created"] 
-
-                conn = get_db_connection()
-                cur = conn.cursor(cursor_factory=RealDictCursor)
-                
-                # --- Lógica de Fuzzy Match (Vínculo Automático) ---
-                cur.execute("SELECT id, full_name FROM members")
-                members = cur.fetchall()
-                
-                best_match_id = None
-                if members:
-                    choices = {m['full_name']: m['id'] for m in members}
-                    # Tenta achar o nome mais parecido na lista de membros
-                    match = process.extractOne(payer_name, choices.keys())
-                    # Se tiver mais de 85% de semelhança, vincula
-                    if match and match[1] >= 85: 
-                        best_match_id = choices[match[0]]
-
-                # Insere Transação
-                cur.execute("""
-                    INSERT INTO transactions (mp_id, payer_name, member_id, amount, transaction_date, status, origin)
-                    VALUES (%s, %s, %s, %s, %s, 'pendente', 'pix')
-                    ON CONFLICT (mp_id) DO NOTHING
-                """, (str(payment_id), payer_name, best_match_id, amount, date_created))
-                conn.commit()
-                cur.close()
-                conn.close()
-        except Exception as e:
-            print(f"Erro no webhook: {e}")
+        executor.submit(_process_payment, payment_id)
+        return jsonify({"status": "queued"}), 200
 
     return jsonify({"status": "ok"}), 200
 
@@ -149,123 +320,174 @@ def mp_webhook():
 
 @app.route('/api/dashboard', methods=['GET'])
 def get_dashboard():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # Soma entradas confirmadas do mês atual
-    cur.execute("""
-        SELECT SUM(amount) as total FROM transactions 
-        WHERE status = 'confirmado' AND EXTRACT(MONTH FROM transaction_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-    """)
-    res_in = cur.fetchone()
-    inflow = res_in['total'] if res_in and res_in['total'] else 0
-    
-    # Soma saídas do mês atual
-    cur.execute("""
-        SELECT SUM(amount) as total FROM expenses 
-        WHERE EXTRACT(MONTH FROM expense_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-    """)
-    res_out = cur.fetchone()
-    outflow = res_out['total'] if res_out and res_out['total'] else 0
-    
-    cur.close()
-    conn.close()
-    return jsonify({"inflow": float(inflow), "outflow": float(outflow), "balance": float(inflow - outflow)})
+    month = current_month()
+    key = None
+    if not dash_redis:
+        with _dash_lock:
+            gen = _dash_cache["gen"]
+            if _dash_cache["v"] and _dash_cache["month"] == month and time.time() - _dash_cache["t"] < _DASH_TTL:
+                return jsonify(_dash_cache["v"])
+    else:
+        try:
+            gen = int(dash_redis.get("dash:gen") or 0)
+            key = f"dash:{month}:{gen}"
+            cached = dash_redis.get(key)
+            if cached:
+                return jsonify(json.loads(cached))
+        except redis.RedisError as e:
+            print(f"Erro ao ler cache do dashboard: {e}")
+            key = None
+
+    with db_cursor() as (conn, cur):
+        # Soma entradas confirmadas e saídas do mês atual em uma única ida ao banco
+        execute_prepared(conn, cur, "dashboard_totals")
+        inflow, outflow = cur.fetchone()
+    res = {"inflow": float(inflow), "outflow": float(outflow), "balance": float(inflow - outflow)}
+    if not dash_redis:
+        with _dash_lock:
+            # Só grava se nada foi alterado durante a consulta
+            if _dash_cache["gen"] == gen:
+                _dash_cache.update(t=time.time(), month=month, v=res)
+    elif key:
+        try:
+            dash_redis.setex(key, _DASH_TTL, json.dumps(res))
+        except redis.RedisError as e:
+            print(f"Erro ao gravar cache do dashboard: {e}")
+    return jsonify(res)
 
 @app.route('/api/members', methods=['GET', 'POST', 'DELETE'])
 def manage_members():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    if request.method == 'GET':
-        cur.execute("SELECT * FROM members ORDER BY full_name")
-        res = cur.fetchall()
-        for r in res:
-            if r['birth_date']: r['birth_date'] = r['birth_date'].strftime('%Y-%m-%d')
+    with db_cursor(True) as (conn, cur):
+        if request.method == 'GET':
+            cur.execute("SELECT * FROM members ORDER BY full_name")
+            res = cur.fetchall()
+            for r in res:
+                if r['birth_date']: r['birth_date'] = r['birth_date'].strftime('%Y-%m-%d')
     
-    elif request.method == 'POST':
-        data = request.json
-        cur.execute("INSERT INTO members (code, full_name, birth_date) VALUES (%s, %s, %s)",
-                    (data['code'], data['full_name'], data['birth_date']))
-        conn.commit()
-        res = {"msg": "Membro adicionado"}
+        elif request.method == 'POST':
+            data = request.json
+            cur.execute("INSERT INTO members (code, full_name, birth_date) VALUES (%s, %s, %s)",
+                        (data['code'], data['full_name'], data['birth_date']))
+            conn.commit()
+            res = {"msg": "Membro adicionado"}
 
-    elif request.method == 'DELETE':
-        m_id = request.args.get('id')
-        cur.execute("DELETE FROM members WHERE id = %s", (m_id,))
-        conn.commit()
-        res = {"msg": "Membro removido"}
-
-    cur.close()
-    conn.close()
+        elif request.method == 'DELETE':
+            m_id = request.args.get('id')
+            cur.execute("DELETE FROM members WHERE id = %s", (m_id,))
+            conn.commit()
+            res = {"msg": "Membro removido"}
     return jsonify(res)
 
 @app.route('/api/transactions', methods=['GET', 'POST'])
 def manage_transactions():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    if request.method == 'GET':
-        cur.execute("""
-            SELECT t.*, m.code as member_code, m.full_name as member_real_name 
-            FROM transactions t 
-            LEFT JOIN members m ON t.member_id = m.id
-            ORDER BY t.transaction_date DESC
-        """)
-        res = cur.fetchall()
-        for r in res:
-            if r['transaction_date']: r['transaction_date'] = r['transaction_date'].isoformat()
-            if r['amount']: r['amount'] = float(r['amount'])
+    with db_cursor(True) as (conn, cur):
+        if request.method == 'GET':
+            # Datas e valores já formatados pelo banco, prontos para o JSON
+            cur.execute("""
+                SELECT t.id, t.mp_id, t.payer_name, t.member_id, t.amount::float8 AS amount,
+                       to_char(t.transaction_date, 'YYYY-MM-DD"T"HH24:MI:SS') AS transaction_date,
+                       t.status, t.origin, t.type,
+                       m.code as member_code, m.full_name as member_real_name 
+                FROM transactions t 
+                LEFT JOIN members m ON t.member_id = m.id
+                ORDER BY t.transaction_date DESC
+            """)
+            res = cur.fetchall()
         
-    elif request.method == 'POST':
-        data = request.json
-        action = data.get('action')
+        elif request.method == 'POST':
+            data = request.json
+            action = data.get('action')
         
-        if action == 'confirm':
-            cur.execute("UPDATE transactions SET type = %s, status = 'confirmado' WHERE id = %s",
-                        (data['type'], data['id']))
-        elif action == 'manual_add':
-            cur.execute("""
-                INSERT INTO transactions (payer_name, amount, type, status, origin, transaction_date)
-                VALUES (%s, %s, %s, 'confirmado', 'manual', NOW())
-            """, (data['name'], data['amount'], data['type']))
+            if action == 'confirm':
+                cur.execute("UPDATE transactions SET type = %s, status = 'confirmado' WHERE id = %s",
+                            (data['type'], data['id']))
+            elif action == 'manual_add':
+                cur.execute("""
+                    INSERT INTO transactions (payer_name, amount, type, status, origin, transaction_date)
+                    VALUES (%s, %s, %s, 'confirmado', 'manual', NOW())
+                """, (data['name'], data['amount'], data['type']))
             
-        conn.commit()
-        res = {"msg": "Sucesso"}
-
-    cur.close()
-    conn.close()
+            conn.commit()
+            invalidate_dashboard_cache()
+            res = {"msg": "Sucesso"}
     return jsonify(res)
 
+def _valid_bulk_item(t):
+    if not isinstance(t, dict) or t.get('mp_id') is None or t.get('amount') is None:
+        return False
+    # bool é subclasse de int e float() aceita "inf"/"nan": ambos ficam de fora
+    if isinstance(t['amount'], bool) or isinstance(t.get('member_id'), bool):
+        return False
+    try:
+        if not math.isfinite(float(t['amount'])):
+            return False
+    except (TypeError, ValueError):
+        return False
+    if t.get('member_id') is not None and not isinstance(t['member_id'], int):
+        return False
+    if t.get('transaction_date') is not None:
+        try:
+            datetime.fromisoformat(str(t['transaction_date']).replace('Z', '+00:00'))
+        except ValueError:
+            return False
+    return True
+
+@app.route('/api/transactions/bulk', methods=['POST'])
+def bulk_transactions():
+    # Importação em lote (backfill/sincronização): todas as linhas em uma única ida ao banco
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not all(_valid_bulk_item(t) for t in data):
+        return jsonify({"error": "Envie uma lista de transações com mp_id, amount válido e, opcionalmente, "
+                                 "member_id inteiro e transaction_date no formato ISO"}), 400
+
+    # Assim como no webhook, entram como PIX pendente e são confirmadas pela tela de transações
+    rows = [(str(t['mp_id']), t.get('payer_name'), t.get('member_id'), t['amount'], t.get('transaction_date'))
+            for t in data]
+    try:
+        with db_cursor() as (conn, cur):
+            inserted = execute_values(cur, """
+                INSERT INTO transactions (mp_id, payer_name, member_id, amount, transaction_date, status, origin)
+                VALUES %s
+                ON CONFLICT (mp_id) DO NOTHING
+                RETURNING id
+            """, rows, template="(%s, %s, %s, %s, COALESCE(%s::timestamp, CURRENT_TIMESTAMP), 'pendente', 'pix')",
+                page_size=500, fetch=True)
+            conn.commit()
+    except (pg_errors.DataError, pg_errors.IntegrityError) as e:
+        # Ex.: member_id inexistente ou valor fora do tamanho da coluna; nada do lote é gravado
+        return jsonify({"error": f"Lote rejeitado: {e.pgerror or e}"}), 400
+    return jsonify({"msg": f"{len(inserted)} de {len(rows)} transações inseridas"})
+
 @app.route('/api/expenses', methods=['GET', 'POST', 'DELETE'])
 def manage_expenses():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    if request.method == 'GET':
-        cur.execute("SELECT * FROM expenses ORDER BY expense_date DESC")
-        res = cur.fetchall()
-        for r in res:
-            if r['expense_date']: r['expense_date'] = r['expense_date'].strftime('%Y-%m-%d')
-            if r['amount']: r['amount'] = float(r['amount'])
+    with db_cursor(True) as (conn, cur):
+        if request.method == 'GET':
+            cur.execute("""
+                SELECT id, description, category, amount::float8 AS amount,
+                       to_char(expense_date, 'YYYY-MM-DD') AS expense_date
+                FROM expenses ORDER BY expense_date DESC
+            """)
+            res = cur.fetchall()
         
-    elif request.method == 'POST':
-        data = request.json
-        cur.execute("INSERT INTO expenses (description, category, amount, expense_date) VALUES (%s, %s, %s, %s)",
-                    (data['description'], data['category'], data['amount'], data['date']))
-        conn.commit()
-        res = {"msg": "Despesa salva"}
-
-    elif request.method == 'DELETE':
-        e_id = request.args.get('id')
-        cur.execute("DELETE FROM expenses WHERE id = %s", (e_id,))
-        conn.commit()
-        res = {"msg": "Despesa removida"}
+        elif request.method == 'POST':
+            data = request.json
+            cur.execute("INSERT INTO expenses (description, category, amount, expense_date) VALUES (%s, %s, %s, %s)",
+                        (data['description'], data['category'], data['amount'], data['date']))
+            conn.commit()
+            invalidate_dashboard_cache()
+            res = {"msg": "Despesa salva"}
 
-    cur.close()
-    conn.close()
+        elif request.method == 'DELETE':
+            e_id = request.args.get('id')
+            cur.execute("DELETE FROM expenses WHERE id = %s", (e_id,))
+            conn.commit()
+            invalidate_dashboard_cache()
+            res = {"msg": "Despesa removida"}
     return jsonify(res)
 
+# Formatação de valores das linhas do relatório (os valores já vêm como float do banco)
+_FMT = "R$ {:.2f}".format
+
 @app.route('/api/report/final', methods=['POST'])
 def generate_report():
     data = request.json
@@ -273,92 +495,79 @@ def generate_report():
     year = int(data['year'])
     prev_balance = float(data['prev_balance'])
     
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # Entradas Confirmadas
-    cur.execute("""
-        SELECT t.amount, t.transaction_date, t.type, m.code 
-        FROM transactions t
-        LEFT JOIN members m ON t.member_id = m.id
-        WHERE status = 'confirmado' 
-        AND EXTRACT(MONTH FROM transaction_date) = %s 
-        AND EXTRACT(YEAR FROM transaction_date) = %s
-    """, (month, year))
-    inflows = cur.fetchall()
-    
-    # Saídas
-    cur.execute("""
-        SELECT * FROM expenses 
-        WHERE EXTRACT(MONTH FROM expense_date) = %s 
-        AND EXTRACT(YEAR FROM expense_date) = %s
-    """, (month, year))
-    outflows = cur.fetchall()
+    with db_cursor(True) as (conn, cur):
+        # Entradas Confirmadas
+        cur.execute("""
+            SELECT t.amount::float8 AS amount, t.transaction_date, t.type, m.code, SUM(t.amount) OVER () AS total
+            FROM transactions t
+            LEFT JOIN members m ON t.member_id = m.id
+            WHERE status = 'confirmado' 
+            AND transaction_date >= make_date(%(year)s, %(month)s, 1)
+            AND transaction_date < make_date(%(year)s, %(month)s, 1) + INTERVAL '1 month'
+        """, {"month": month, "year": year})
+        inflows = cur.fetchall()
     
-    cur.close()
-    conn.close()
+        # Saídas
+        cur.execute("""
+            SELECT COALESCE(to_char(expense_date, 'DD/MM/YYYY'), '-') AS expense_date, description,
+                   amount::float8 AS amount, SUM(amount) OVER () AS total
+            FROM expenses 
+            WHERE expense_date >= make_date(%(year)s, %(month)s, 1)
+            AND expense_date < make_date(%(year)s, %(month)s, 1) + INTERVAL '1 month'
+        """, {"month": month, "year": year})
+        outflows = cur.fetchall()
     
-    total_in = sum([float(i['amount']) for i in inflows])
-    total_out = sum([float(o['amount']) for o in outflows])
+    # Totais já calculados no banco (SUM ... OVER ()), repetidos em cada linha
+    total_in = float(inflows[0]['total']) if inflows else 0.0
+    total_out = float(outflows[0]['total']) if outflows else 0.0
     final_balance = (prev_balance + total_in) - total_out
     
     # Geração do PDF
+    # Usa a fonte core "helvetica" direto (Arial era só um apelido para ela) e os
+    # parâmetros atuais do fpdf2, evitando a substituição de fonte e os avisos de
+    # depreciação a cada chamada
     pdf = FPDF()
     pdf.add_page()
-    pdf.set_font("Arial", 'B', 16)
-    pdf.cell(0, 10, txt=f"Relatorio Financeiro - {month}/{year}", ln=True, align='C')
+    pdf.set_font("helvetica", 'B', 16)
+    pdf.cell(0, 10, text=f"Relatorio Financeiro - {month}/{year}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
     
-    pdf.set_font("Arial", size=12)
+    pdf.set_font("helvetica", size=12)
     pdf.ln(10)
     
     pdf.set_fill_color(230, 240, 255)
-    pdf.cell(0, 10, f"Saldo Mes Anterior: R$ {prev_balance:.2f}", ln=True, fill=True)
-    pdf.cell(0, 10, f"(+) Total Entradas: R$ {total_in:.2f}", ln=True, fill=True)
-    pdf.cell(0, 10, f"(-) Total Saidas: R$ {total_out:.2f}", ln=True, fill=True)
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0, 10, f"(=) Saldo a Transportar: R$ {final_balance:.2f}", ln=True, border=1)
+    pdf.cell(0, 10, f"Saldo Mes Anterior: R$ {prev_balance:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, fill=True)
+    pdf.cell(0, 10, f"(+) Total Entradas: R$ {total_in:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, fill=True)
+    pdf.cell(0, 10, f"(-) Total Saidas: R$ {total_out:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, fill=True)
+    pdf.set_font("helvetica", 'B', 12)
+    pdf.cell(0, 10, f"(=) Saldo a Transportar: R$ {final_balance:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, border=1)
     
     pdf.ln(10)
-    pdf.set_font("Arial", 'B', 14)
-    pdf.cell(0, 10, "Detalhe - Entradas", ln=True)
-    pdf.set_font("Arial", size=10)
+    pdf.set_font("helvetica", 'B', 14)
+    pdf.cell(0, 10, "Detalhe - Entradas", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("helvetica", size=10)
     
-    pdf.cell(30, 7, "Data", 1)
-    pdf.cell(30, 7, "Codigo", 1)
-    pdf.cell(30, 7, "Tipo", 1)
-    pdf.cell(40, 7, "Valor", 1)
-    pdf.ln()
-    
-    for row in inflows:
-        d = row['transaction_date'].strftime("%d/%m/%Y")
-        c = row['code'] if row['code'] else "---"
-        pdf.cell(30, 7, d, 1)
-        pdf.cell(30, 7, c, 1)
-        pdf.cell(30, 7, row['type'], 1)
-        pdf.cell(40, 7, f"R$ {float(row['amount']):.2f}", 1)
-        pdf.ln()
+    with pdf.table(col_widths=(30, 30, 30, 40), width=130, align="LEFT", line_height=7) as table:
+        table.row(("Data", "Codigo", "Tipo", "Valor"))
+        for row in inflows:
+            d = row['transaction_date'].strftime("%d/%m/%Y")
+            c = row['code'] if row['code'] else "---"
+            table.row((d, c, row['type'], _FMT(row['amount'])))
 
     pdf.ln(10)
-    pdf.set_font("Arial", 'B', 14)
-    pdf.cell(0, 10, "Detalhe - Saidas", ln=True)
-    pdf.set_font("Arial", size=10)
-
-    pdf.cell(30, 7, "Data", 1)
-    pdf.cell(100, 7, "Descricao", 1)
-    pdf.cell(40, 7, "Valor", 1)
-    pdf.ln()
-    for row in outflows:
-        d = row['expense_date'].strftime("%d/%m/%Y") if row['expense_date'] else "-"
-        pdf.cell(30, 7, d, 1)
-        pdf.cell(100, 7, row['description'], 1)
-        pdf.cell(40, 7, f"R$ {float(row['amount']):.2f}", 1)
-        pdf.ln()
-
-    # Salva no diretório temporário do sistema (obrigatório para Render/Serverless)
-    file_name = f"/tmp/relatorio_{month}_{year}.pdf"
-    pdf.output(file_name)
+    pdf.set_font("helvetica", 'B', 14)
+    pdf.cell(0, 10, "Detalhe - Saidas", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("helvetica", size=10)
+
+    with pdf.table(col_widths=(30, 100, 40), width=170, align="LEFT", line_height=7) as table:
+        table.row(("Data", "Descricao", "Valor"))
+        for row in outflows:
+            table.row((row['expense_date'], row['description'], _FMT(row['amount'])))
+
+    # Gera o PDF em memória e envia direto, sem passar pelo disco
+    buf = io.BytesIO(pdf.output())
     
-    return send_file(file_name, as_attachment=True)
+    return send_file(buf, mimetype='application/pdf', as_attachment=True,
+                     download_name=f"relatorio_{month}_{year}.pdf")
 
 if __name__ == '__main__':
     # Roda localmente para testes
@@ -0,0 +1,8 @@
+# Configuração lida automaticamente pelo gunicorn (ver Procfile)
+
+def post_fork(server, worker):
+    # Torna o psycopg2 cooperativo com o gevent, apenas nos workers "-k gevent";
+    # rodando com "python app.py" ou workers sync o psycopg2 fica como está
+    if "gevent" in server.cfg.worker_class_str:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()